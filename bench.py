@@ -0,0 +1,298 @@
+"""
+Benchmarks for verbs.py on synthetic repos.
+
+nvr, fzf, bat, ctags and nix-shell are replaced by fake executables so the
+numbers only depend on verbs.py and the shell pipelines it builds.
+
+    python bench.py --sizes 1000,10000 --output bench.json
+    python bench.py --compare old.json new.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+HERE = Path(__file__).resolve().parent
+
+STUBS = {
+    "nvr": """#!/bin/sh
+case "$*" in
+    *background*) echo dark ;;
+    *getcwd*) pwd ;;
+esac
+""",
+    # Pick the last candidate, like a user accepting the top match with --tac
+    "fzf": """#!/bin/sh
+tail -n 1
+""",
+    "bat": """#!/bin/sh
+for arg; do [ -f "$arg" ] && cat "$arg"; done
+""",
+    "ctags": """#!/bin/sh
+for file; do
+    case "$file" in -*) continue ;; esac
+    printf '%s\\t%s\\t1;"\\n' "$(basename "$file")" "$file"
+done
+""",
+    "nix-shell": """#!/bin/sh
+while [ "$1" != "--run" ]; do shift; done
+exec sh -c "$2"
+""",
+}
+
+FILTER_KEYS = ["f", "/", "t", "r"]
+
+
+def make_stubs(root):
+    bindir = root / "bin"
+    bindir.mkdir()
+    for name, script in STUBS.items():
+        path = bindir / name
+        path.write_text(script)
+        path.chmod(0o755)
+    return bindir
+
+
+def git(repo, *args):
+    subprocess.check_call(
+        ["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost", *args],
+        cwd=repo,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def make_repo(root, files, depth=8, huge_lines=200_000):
+    """
+    Create a git repo with `files` small files spread over a tree `depth`
+    levels deep, one huge file, a feature branch and some uncommitted changes.
+    """
+    repo = root / f"repo-{files}"
+    repo.mkdir()
+    for i in range(files):
+        parts = [f"d{(i >> (2 * level)) % 4}" for level in range(depth)]
+        path = repo.joinpath(*parts[: 1 + i % depth], f"file{i}.py")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f"def func{i}():\n    return {i}\n")
+    (repo / "huge.txt").write_text("".join(f"line {i}\n" for i in range(huge_lines)))
+
+    git(repo, "init", "-q", "-b", "main")
+    git(repo, "add", "-A")
+    git(repo, "commit", "-q", "-m", "init")
+    git(repo, "checkout", "-q", "-b", "work")
+    (repo / "changed.py").write_text("changed = True\n")
+    git(repo, "add", "changed.py")
+    git(repo, "commit", "-q", "-m", "work")
+    with (repo / "huge.txt").open("a") as huge:
+        huge.write("dirty\n")
+    return repo
+
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "max": max(times),
+        "repeat": repeat,
+    }
+
+
+def bench_cold_start(repo, repeat):
+    # main() without entering the curses loop, in a fresh interpreter. The
+    # background prefetch would otherwise be timed too.
+    code = (
+        "import sys, verbs;"
+        "verbs.App.main = lambda self: None;"
+        f"sys.argv = ['verbs', {str(repo / 'huge.txt')!r}, '10', ''];"
+        "verbs.main()"
+    )
+    return timeit(
+        lambda: subprocess.check_call(
+            [sys.executable, "-c", code],
+            cwd=HERE,
+            env=dict(os.environ, VERBS_PREFETCH="0"),
+        ),
+        repeat,
+    )
+
+
+class FakeScreen:
+    def __init__(self, keys):
+        self.keys = iter(keys)
+
+    def clear(self):
+        pass
+
+    def addstr(self, *args):
+        pass
+
+    def refresh(self):
+        pass
+
+    def getkey(self):
+        try:
+            return next(self.keys)
+        except StopIteration:
+            raise KeyboardInterrupt
+
+
+def bench_keypress(verbs, repo, keys):
+    sent = (["j", "k"] * keys)[:keys]
+    screen = FakeScreen(sent)
+    app = verbs.App()
+    app.go(str(repo))
+    app.screen = lambda func, *args: func(screen, *args)
+    start = perf_counter()
+    try:
+        app._main()
+    except KeyboardInterrupt:
+        pass
+    app.prefetcher.cancel()
+    return {"per_key": (perf_counter() - start) / len(sent), "keys": len(sent)}
+
+
+def bench_go(verbs, repo, repeat):
+    app = verbs.App()
+    result = timeit(lambda: app.go(str(repo / "huge.txt"), "10"), repeat)
+    app.prefetcher.cancel()
+    return result
+
+
+def bench_filter(verbs, repo, key, repeat, idle=False):
+    """
+    Time a filter verb pressed right after navigating. With `idle` the
+    prefetched input is given time to finish before the key is pressed.
+    """
+    # Same choice as the fzf stub, without needing a terminal
+    verbs.FuzzyPicker.pick = lambda picker, screen: picker.lines[picker.ranked()[-1]]
+    verb_cls = next(
+        v
+        for v in verbs.inheritors(verbs.FilterVerb)
+        if getattr(v, "map", None) == key
+    )
+
+    times = []
+    for _ in range(repeat):
+        app = verbs.App()
+        app.go(str(repo))
+        if idle:
+            for job, future in app.prefetcher.jobs.values():
+                future.result()
+        start = perf_counter()
+        verb_cls(app)()
+        times.append(perf_counter() - start)
+        app.prefetcher.cancel()
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "max": max(times),
+        "repeat": repeat,
+    }
+
+
+def run_benchmarks(args):
+    root = Path(tempfile.mkdtemp(prefix="verbs-bench-"))
+    try:
+        bindir = make_stubs(root)
+        os.environ["PATH"] = f"{bindir}{os.pathsep}{os.environ['PATH']}"
+        # Keep ~/.verbs_hist and friends out of the user's home
+        os.environ["HOME"] = str(root)
+        (root / ".bash_eternal_history").write_text("true\n")
+
+        sys.path.insert(0, str(HERE))
+        import verbs
+
+        results = {
+            "commit": subprocess.run(
+                ["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True
+            ).stdout.decode().strip(),
+            "python": sys.version.split()[0],
+            "sizes": {},
+        }
+        for size in args.sizes:
+            print(f"generating repo with {size} files", file=sys.stderr)
+            repo = make_repo(root, size, depth=args.depth)
+            result = {
+                "cold_start": bench_cold_start(repo, args.repeat),
+                "keypress": bench_keypress(verbs, repo, args.keys),
+                "go": bench_go(verbs, repo, args.repeat),
+                "filter": {},
+                "filter_idle": {},
+            }
+            for key in FILTER_KEYS:
+                print(f"  filter {key!r}", file=sys.stderr)
+                result["filter"][key] = bench_filter(verbs, repo, key, args.repeat)
+                result["filter_idle"][key] = bench_filter(
+                    verbs, repo, key, args.repeat, idle=True
+                )
+            results["sizes"][str(size)] = result
+            shutil.rmtree(repo)
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def flatten(results):
+    flat = {}
+    for size, result in results["sizes"].items():
+        for name, value in result.items():
+            if name in ("filter", "filter_idle"):
+                for key, timing in value.items():
+                    flat[f"{size}/{name} {key}"] = timing["median"]
+            elif name == "keypress":
+                flat[f"{size}/keypress"] = value["per_key"]
+            else:
+                flat[f"{size}/{name}"] = value["median"]
+    return flat
+
+
+def compare(old_file, new_file):
+    old = flatten(json.loads(Path(old_file).read_text()))
+    new = flatten(json.loads(Path(new_file).read_text()))
+    for name in sorted(old.keys() & new.keys()):
+        ratio = new[name] / old[name] if old[name] else float("inf")
+        print(
+            f"{name:24} {old[name] * 1000:10.2f}ms {new[name] * 1000:10.2f}ms"
+            f" {ratio:6.2f}x"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [int(i) for i in s.split(",")],
+        default=[1000, 10000, 100000],
+        help="comma separated file counts of the synthetic repos",
+    )
+    parser.add_argument("--depth", type=int, default=8, help="directory depth")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--keys", type=int, default=50, help="keypresses to time")
+    parser.add_argument("--output", help="write json results here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = json.dumps(run_benchmarks(args), indent=2)
+    if args.output:
+        Path(args.output).write_text(results)
+    else:
+        print(results)
+
+
+if __name__ == "__main__":
+    main()
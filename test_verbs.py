@@ -0,0 +1,518 @@
+import os
+import json
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import verbs
+
+
+@pytest.fixture(autouse=True)
+def no_prefetch(monkeypatch):
+    monkeypatch.setattr(verbs, "PREFETCH", False)
+
+
+@pytest.fixture
+def nvr(tmp_path_factory, monkeypatch):
+    """
+    An nvr on PATH that logs its arguments and answers &background
+    """
+    bindir = tmp_path_factory.mktemp("bin")
+    log = bindir / "log"
+    script = bindir / "nvr"
+    script.write_text(f'#!/bin/sh\necho "$*" >> {log}\necho dark\n')
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    return log
+
+
+def git(repo, *args):
+    subprocess.check_call(
+        ["git", "-c", "user.name=Ann", "-c", "user.email=ann@localhost", *args],
+        cwd=repo,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+@pytest.fixture
+def repo(tmp_path):
+    git(tmp_path, "init", "-q")
+    return tmp_path
+
+
+@pytest.fixture
+def prefetch(monkeypatch):
+    monkeypatch.setattr(verbs, "PREFETCH", True)
+    # Only the file list, with a command that needs nothing installed
+    for verb in verbs.inheritors(verbs.FilterVerb):
+        monkeypatch.setattr(verb, "prefetch", verb is verbs.FilterFilesVerb)
+
+
+def prefetch_job(app):
+    verb = verbs.FilterFilesVerb(app)
+    key = (verb.input_command, verb.input_cwd)
+    return key, app.prefetcher.jobs[key]
+
+
+def test_prefetch_result(repo, prefetch, monkeypatch):
+    monkeypatch.setattr(verbs.FilterFilesVerb, "files_command", "printf 'a\\nb\\n'")
+    app = verbs.App()
+    app.go(str(repo))
+    key, (job, future) = prefetch_job(app)
+    future.result(timeout=5)
+    assert app.prefetcher.result(*key) == b"a\nb\n"
+    # Used up, pressing the key again runs the command
+    assert app.prefetcher.result(*key) is None
+
+
+def test_prefetch_unfinished(repo, prefetch, monkeypatch):
+    monkeypatch.setattr(verbs.FilterFilesVerb, "files_command", "sleep 10")
+    app = verbs.App()
+    app.go(str(repo))
+    key, (job, future) = prefetch_job(app)
+    start = time.perf_counter()
+    assert app.prefetcher.result(*key) is None
+    assert time.perf_counter() - start < 1
+    assert job.cancelled
+
+
+def test_prefetch_navigate_cancels(repo, prefetch, monkeypatch):
+    monkeypatch.setattr(verbs.FilterFilesVerb, "files_command", "sleep 10")
+    (repo / "sub").mkdir()
+    app = verbs.App()
+    app.go(str(repo))
+    _, (job, future) = prefetch_job(app)
+    app.go("sub")
+    assert job.cancelled
+    assert [cwd for _, cwd in app.prefetcher.jobs] == [str(repo / "sub")]
+    app.prefetcher.cancel()
+
+
+def test_prefetch_only_in_git(tmp_path, prefetch):
+    app = verbs.App()
+    app.go(str(tmp_path))
+    assert app.prefetcher.jobs == {}
+
+
+def test_prefetch_max(repo, prefetch, monkeypatch):
+    monkeypatch.setattr(verbs, "PREFETCH_MAX", 4)
+    monkeypatch.setattr(verbs.FilterFilesVerb, "files_command", "yes")
+    app = verbs.App()
+    app.go(str(repo))
+    key, (job, future) = prefetch_job(app)
+    assert future.result(timeout=5) is None
+    assert app.prefetcher.result(*key) is None
+
+
+@pytest.fixture
+def nvim():
+    pynvim = pytest.importorskip("pynvim")
+    if not shutil.which("nvim"):
+        pytest.skip("nvim not installed")
+    nvim = pynvim.attach("child", argv=["nvim", "--embed", "--headless", "--clean"])
+    yield nvim
+    nvim.close()
+
+
+def test_nvim_frontend(nvim, tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    app = verbs.NvimApp(nvim)
+    app.go(str(tmp_path))
+
+    nvim.input("<Down>")
+    assert app.draw([verbs.QuitVerb(app), verbs.CdHomeVerb(app)]) == "KEY_DOWN"
+    assert len(nvim.api.list_wins()) == 2
+    lines = nvim.api.buf_get_lines(app.buf, 0, -1, False)
+    assert lines[1] == f" {tmp_path}"
+    assert " * [q]  Quit" in lines
+    assert "   [h]  Home" in lines
+
+    nvim.input("<CR>")
+    assert app.draw([verbs.QuitVerb(app)]) == "\n"
+
+    with pytest.raises(SystemExit):
+        app.close()
+    assert len(nvim.api.list_wins()) == 1
+
+
+def test_nvim_connects_before_drawing(monkeypatch, tmp_path):
+    class FakeNvim:
+        def eval(self, expr):
+            return str(tmp_path)
+
+    monkeypatch.setattr(
+        verbs.NvimGUIMixin, "connect", lambda app: setattr(app, "nvim", FakeNvim())
+    )
+    # What main() does for a file that doesn't exist
+    app = verbs.NvimApp()
+    assert app.vim_eval("getcwd()") == str(tmp_path)
+
+
+def test_background_from_vim(nvr, tmp_path):
+    # Importing verbs asked nothing
+    assert not nvr.exists()
+    app = verbs.App()
+    app.go(str(tmp_path))
+    fzf = verbs.FilterFilesVerb(app).fzf_command()
+    assert "--color=dark,bg+:#073642" in fzf
+    assert app.env() == {"BAT_THEME": "Solarized (dark)"}
+    assert nvr.read_text() == "--remote-expr &background\n"
+
+
+def test_nvim_background_over_rpc(monkeypatch, tmp_path):
+    class FakeNvim:
+        def eval(self, expr):
+            return {"&background": "light"}[expr]
+
+    app = verbs.NvimApp(FakeNvim())
+    app.go(str(tmp_path))
+    assert "--color=light,bg+:#eee8d5" in verbs.FindLines(app).fzf_command()
+
+
+@pytest.fixture
+def recording_app(monkeypatch):
+    """
+    An App that records what it would run in vim or a terminal
+    """
+    app = verbs.App()
+    app.calls = []
+    monkeypatch.setattr(app, "vim", lambda command: app.calls.append(("vim", command)))
+    monkeypatch.setattr(
+        app, "run", lambda *args, **kwargs: app.calls.append(("run", args, kwargs))
+    )
+    monkeypatch.setattr(app, "close", lambda: app.calls.append(("close",)))
+    return app
+
+
+@pytest.fixture
+def odd_file(repo):
+    path = repo / "dir x" / "a b|c%#.txt"
+    path.parent.mkdir()
+    path.write_text("text\n")
+    return path
+
+
+def test_fnameescape():
+    assert verbs.fnameescape("/a b/c|d%e#f") == "/a\\ b/c\\|d\\%e\\#f"
+    assert verbs.fnameescape("+x") == "\\+x"
+    assert verbs.fnameescape("-") == "\\-"
+    assert verbs.fnameescape("plain/path.py") == "plain/path.py"
+
+
+def test_command_placeholders(recording_app, repo, odd_file):
+    recording_app.go(str(odd_file), "3")
+    assert verbs.RunEditVerb(recording_app).placeholders() == {
+        "path": str(odd_file),
+        "line": "3",
+        "dir": str(odd_file.parent),
+        "pdir": repo.name,
+        "relpath": "dir x/a b|c%#.txt",
+    }
+
+
+def test_command_vim(recording_app, odd_file):
+    recording_app.go(str(odd_file), "3")
+    verbs.RunEditVerb(recording_app)()
+    escaped = str(odd_file.parent).replace(" ", "\\ ") + "/a\\ b\\|c\\%\\#.txt"
+    assert recording_app.calls == [
+        ("vim", f"wincmd p | e {escaped} | 3"),
+        ("close",),
+    ]
+
+
+def test_command_argv(recording_app, odd_file):
+    recording_app.go(str(odd_file))
+    verb = verbs.RunBashVerb(recording_app)
+    verb.argv = ["echo", "{relpath}"]
+    verb()
+    assert recording_app.calls[0] == (
+        "run",
+        (["echo", "dir x/a b|c%#.txt"],),
+        {"anykey": False},
+    )
+
+
+def test_command_shell(recording_app, odd_file):
+    recording_app.go(str(odd_file), "3")
+    verbs.RunLessVerb(recording_app)()
+    ((kind, (command,), kwargs),) = recording_app.calls
+    assert f" -r 3: {shlex.quote(str(odd_file))} | cat -n | less" in command
+    assert kwargs == {"shell": True, "anykey": False}
+
+
+def test_fuzzy_score():
+    assert verbs.fuzzy_score("abc", "xyz") is None
+    assert verbs.fuzzy_score("ba", "abc") is None
+    assert verbs.fuzzy_score("", "abc") == 0
+    # Consecutive beats word starts beats scattered
+    assert verbs.fuzzy_score("ab", "ab") == 6
+    assert verbs.fuzzy_score("ab", "a/b") == 5
+    assert verbs.fuzzy_score("ab", "axb") == 2
+
+
+def test_fuzzy_picker():
+    lines = ["src/verbs.py", "README.md", "bench.py", "test_verbs.py"]
+    picker = verbs.FuzzyPicker(lines)
+    assert picker.ranked() == [0, 1, 2, 3]
+
+    picker.push("v")
+    picker.push("P")
+    assert [lines[i] for i in picker.ranked()] == [
+        "src/verbs.py",
+        "test_verbs.py",
+    ]
+    picker.push("y")
+    assert [lines[i] for i in picker.ranked()] == ["src/verbs.py", "test_verbs.py"]
+
+    picker.pop()
+    picker.pop()
+    assert picker.query == "v"
+    assert sorted(picker.ranked()) == [0, 3]
+    picker.pop()
+    picker.pop()
+    assert picker.ranked() == [0, 1, 2, 3]
+
+    # The initial query is pushed like typing
+    assert verbs.FuzzyPicker(lines, "bench").ranked() == [2]
+
+
+class FakeScreen:
+    def __init__(self, keys):
+        self.keys = iter(keys)
+
+    def getmaxyx(self):
+        return 24, 80
+
+    def clear(self):
+        pass
+
+    def addstr(self, *args):
+        pass
+
+    def refresh(self):
+        pass
+
+    def getkey(self):
+        return next(self.keys)
+
+
+@pytest.mark.parametrize(
+    "keys, fzf_out",
+    [(["r", "e", "\n"], "\nREADME.md"), (["t", "s", "t", " "], " \ntest_verbs.py")],
+)
+def test_picker_handles_like_fzf(tmp_path, monkeypatch, keys, fzf_out):
+    app = verbs.App()
+    app.go(str(tmp_path))
+    monkeypatch.setattr(
+        app, "vim_eval", lambda expr: "src/verbs.py\nREADME.md\ntest_verbs.py"
+    )
+    handled = []
+    monkeypatch.setattr(
+        verbs.FilterVimBufferVerb, "handle", lambda verb, m: handled.append(m)
+    )
+
+    monkeypatch.setattr(app, "screen", lambda func: func(FakeScreen(keys)))
+    verbs.FilterVimBufferVerb(app)()
+
+    monkeypatch.setattr(verbs, "BUILTIN_PICKER_MAX", 0)
+    monkeypatch.setattr(verbs.App, "background", lambda app: "dark")
+    monkeypatch.setattr(app, "interactive", lambda *args, **kwargs: fzf_out)
+    verbs.FilterVimBufferVerb(app)()
+
+    assert handled[0] == handled[1] == fzf_out.split("\n")[-1]
+
+
+@pytest.fixture
+def blamed(repo, tmp_path_factory, monkeypatch):
+    monkeypatch.setattr(verbs, "CACHE_DIR", tmp_path_factory.mktemp("cache"))
+    path = repo / "a.txt"
+    path.write_text("one\ntwo\nthree\n")
+    git(repo, "add", "a.txt")
+    git(repo, "commit", "-q", "-m", "add a")
+    return path
+
+
+def head(repo):
+    out = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo)
+    return out.decode().strip()
+
+
+@pytest.mark.parametrize("flag", ["--porcelain", "--incremental"])
+def test_blame_feed(blamed, flag):
+    app = verbs.App()
+    app.go(str(blamed))
+    cache = verbs.BlameCache(app)
+    out = subprocess.check_output(["git", "blame", flag, "a.txt"], cwd=blamed.parent)
+    data = {"lines": {}, "commits": {}}
+    cache.feed(out.decode().splitlines(), data)
+    sha = head(blamed.parent)
+    assert data["lines"] == {"1": sha, "2": sha, "3": sha}
+    assert data["commits"][sha]["author"] == "Ann"
+    assert data["commits"][sha]["summary"] == "add a"
+
+
+def wait_streamed(cache):
+    for _ in range(500):
+        if cache.file not in verbs.BlameCache.streaming:
+            return
+        time.sleep(0.01)
+    raise TimeoutError
+
+
+def test_blame_from_cache(blamed, monkeypatch):
+    app = verbs.App()
+    app.go(str(blamed), "2")
+    cache = verbs.BlameCache(app)
+    sha = head(blamed.parent)
+    assert cache.blame(2, 2) == [(2, sha)]
+    wait_streamed(cache)
+
+    again = verbs.BlameCache(app)
+
+    def no_git(*args, **kwargs):
+        raise AssertionError("not cached")
+
+    monkeypatch.setattr(verbs, "check_output", no_git)
+    assert again.blame(1, 3) == [(1, sha), (2, sha), (3, sha)]
+
+
+def test_blame_cache_keeps_current_version(blamed):
+    app = verbs.App()
+    app.go(str(blamed), "1")
+    cache = verbs.BlameCache(app)
+    cache.blame(1, 1)
+    wait_streamed(cache)
+
+    with blamed.open("a") as f:
+        f.write("four\n")
+    edited = verbs.BlameCache(app)
+    edited.blame(1, 1)
+    wait_streamed(edited)
+    assert list(edited.file.parent.iterdir()) == [edited.file]
+
+
+def test_blame_uncommitted(blamed, monkeypatch):
+    new = blamed.parent / "new.txt"
+    new.write_text("new\n")
+    app = verbs.App()
+    app.go(str(new), "1")
+    pages = []
+    monkeypatch.setattr(app, "page", pages.append)
+    verbs.BlameVerb(app)()
+    verbs.LogRangeVerb(app)()
+    assert pages == [[f"{new} has no committed history"]] * 2
+
+
+def vim_list(obj):
+    return "'{}'".format(json.dumps(obj).replace("'", "''"))
+
+
+@pytest.mark.parametrize(
+    "verb, out, locations",
+    [
+        (verbs.FilterFilesVerb, "file_a\nfile_b", [("file_a", 1), ("file_b", 1)]),
+        # The --expect line fzf prints first
+        (verbs.FilterFilesVerb, "\nfile_a\nit's", [("file_a", 1), ("it's", 1)]),
+        (verbs.FindLines, "file_a:3:x\nfile_b:4:y:z", [("file_a", 3), ("file_b", 4)]),
+        (
+            verbs.FilterTagsVerb,
+            'main\tfile_a\t3;"\tf\nrun\tfile_b\t4;"\tf',
+            [("file_a", 3), ("file_b", 4)],
+        ),
+    ],
+)
+def test_handle_multi(recording_app, tmp_path, verb, out, locations):
+    recording_app.go(str(tmp_path))
+    verb(recording_app)._handle(out)
+    files = [str(tmp_path / file) for file, _ in locations]
+    items = [{"filename": f, "lnum": line} for f, (_, line) in zip(files, locations)]
+    assert recording_app.calls == [
+        (
+            "vim",
+            "wincmd p"
+            f" | for f in json_decode({vim_list(files)})"
+            " | execute 'badd ' . fnameescape(f)"
+            " | endfor"
+            " | call setqflist([], ' ', {'title': 'verbs', "
+            f"'items': json_decode({vim_list(items)})}})"
+            " | cfirst",
+        ),
+        ("close",),
+    ]
+
+
+def test_handle_single(tmp_path):
+    app = verbs.App()
+    app.go(str(tmp_path))
+    verbs.FindLines(app)._handle("a.py:3:x")
+    assert (app.path, app.line) == (str(tmp_path / "a.py"), "3")
+
+
+@pytest.fixture
+def ollama_stub(monkeypatch):
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            requests.append((self.path, body))
+            if self.path == "/api/chat":
+                parts = [
+                    {"message": {"content": "answer"}, "done": False},
+                    {"done": True, "prompt_eval_count": 30},
+                ]
+            else:
+                parts = [{"done": True}]
+            self.send_response(200)
+            self.end_headers()
+            for part in parts:
+                self.wfile.write(json.dumps(part).encode() + b"\n")
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(verbs, "OLLAMA_HOST", f"http://127.0.0.1:{server.server_port}")
+    yield requests
+    server.shutdown()
+
+
+def test_prompt_stable_prefix(ollama_stub, tmp_path):
+    pytest.importorskip("jinja2")
+    for name in ("a.py", "b.py", "open.py"):
+        (tmp_path / name).write_text(f"{name} content\n")
+    app = verbs.App()
+    app.go(str(tmp_path / "open.py"))
+    verb = verbs.PromptVerb(app)
+
+    prompt = verb.render_prompt(
+        True,
+        project_files=[str(tmp_path / "b.py"), str(tmp_path / "a.py")],
+        include_open_file=True,
+        include_selection=True,
+        selection="SELECTION",
+        user_prompt="QUESTION",
+        dont_think=False,
+    )
+    order = ["a.py content", "b.py content", "open.py content", "SELECTION", "QUESTION"]
+    positions = [prompt.index(part) for part in order]
+    assert positions == sorted(positions)
+
+    verb.preload("ollama/qwen3:4b")
+    assert ollama_stub[-1] == (
+        "/api/generate",
+        {"model": "qwen3:4b", "keep_alive": verb.keep_alive},
+    )
+
+    out = list(verb.stream_stable("ollama/qwen3:4b", 0.8, 0.8, prompt))
+    _, body = next(r for r in ollama_stub if r[0] == "/api/chat")
+    assert body["keep_alive"] == verb.keep_alive == "30m"
+    assert body["messages"] == [{"content": prompt, "role": "user"}]
+    assert out[-1] == "answer\n\n[prompt tokens evaluated: 30]"
+    assert [path for path, _ in ollama_stub] == ["/api/generate", "/api/chat"]
@@ -1,14 +1,24 @@
 import os
+import atexit
 import subprocess
 import sys
 import curses
 import shlex
-from time import sleep
+import signal
+import termios
+import tty
+from time import sleep, perf_counter, strftime, localtime
 from curses import wrapper
 from pathlib import Path
 import json
-from functools import lru_cache
+import hashlib
+from contextlib import contextmanager
+from concurrent.futures import Future
 import textwrap
+import threading
+import weakref
+import urllib.request
+from array import array
 
 CATEGORY_ORDER = [
     "file",
@@ -18,23 +28,129 @@ CATEGORY_ORDER = [
     "ai",
 ]
 
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+
+PREFETCH = os.environ.get("VERBS_PREFETCH", "1") != "0"
+
+# Prefetched output larger than this is thrown away
+PREFETCH_MAX = int(os.environ.get("VERBS_PREFETCH_MAX", 8 * 1024 * 1024))
+
+# Filter verbs with at most this many candidates skip fzf
+BUILTIN_PICKER_MAX = int(os.environ.get("VERBS_BUILTIN_PICKER_MAX", "1000"))
+
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser() / "verbs"
+
+
+class Tracer:
+    """
+    Record spans as Chrome trace events, view the file in ui.perfetto.dev.
+    Enabled by setting VERBS_TRACE to the output path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self.keypresses = 0
+        self.start = perf_counter()
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        if not self.path:
+            yield args
+            return
+        start = perf_counter()
+        try:
+            yield args
+        finally:
+            self.events.append({
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": (start - self.start) * 1e6,
+                "dur": (perf_counter() - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            })
+
+    def summary(self):
+        spawns = [e for e in self.events if e["cat"] == "spawn"]
+        per_key = {}
+        for event in spawns:
+            key = event["args"]["keypress"]
+            per_key[key] = per_key.get(key, 0) + 1
+        verbs = sorted(
+            (e for e in self.events if e["cat"] == "verb"),
+            key=lambda e: e["dur"],
+            reverse=True,
+        )
+        return {
+            "keypresses": self.keypresses,
+            "subprocesses": len(spawns),
+            "subprocesses_per_keypress": len(spawns) / max(self.keypresses, 1),
+            "max_subprocesses_per_keypress": max(per_key.values(), default=0),
+            "slowest_verbs": [
+                {"verb": e["name"], "ms": round(e["dur"] / 1000, 1)}
+                for e in verbs[:10]
+            ],
+        }
+
+    def save(self):
+        if not self.path:
+            return
+        Path(self.path).write_text(
+            json.dumps({
+                "traceEvents": self.events,
+                "displayTimeUnit": "ms",
+                "otherData": {"summary": self.summary()},
+            })
+        )
+
+
+trace = Tracer(os.environ.get("VERBS_TRACE"))
+atexit.register(trace.save)
 
-@lru_cache()
-def background():
-    return (
-        subprocess.check_output(["nvr", "--remote-expr", "&background"])
-        .decode()
-        .strip("\n")
-    )
+
+def cmd_repr(args):
+    if isinstance(args, str):
+        return args
+    return shlex.join(args)
+
+
+def check_output(args, **kwargs):
+    with trace.span(
+        cmd_repr(args), "spawn", cwd=kwargs.get("cwd"), keypress=trace.keypresses
+    ) as info:
+        try:
+            resp = subprocess.check_output(args, **kwargs)
+        except subprocess.CalledProcessError as exc:
+            info["exit"] = exc.returncode
+            raise
+        info["exit"] = 0
+        info["bytes"] = len(resp)
+        return resp
 
 
 def bat(middle="", lines=True):
-    cmd = f"bat --plain --theme 'Solarized ({background()})' --color always {middle}"
+    # The theme comes from $BAT_THEME, see App.env()
+    cmd = f"bat --plain --color always {middle}"
     if lines:
         cmd += " | cat -n "
     return cmd
 
 
+def fnameescape(path):
+    """
+    Escape a path for an Ex command like vim's fnameescape()
+    """
+    escaped = "".join(
+        "\\" + char if char in " \t\n*?[{`$\\%#'\"|!<" else char for char in path
+    )
+    if escaped == "-" or escaped[:1] in ("+", ">"):
+        escaped = "\\" + escaped
+    return escaped
+
+
 # https://stackoverflow.com/questions/5881873/python-find-all-classes-which-inherit-from-this-one
 def inheritors(klass):
     subclasses = set()
@@ -48,6 +164,21 @@ def inheritors(klass):
     return subclasses
 
 
+def ollama(endpoint, payload):
+    """
+    Post to the ollama API and yield the streamed json lines
+    """
+    req = urllib.request.Request(
+        f"{OLLAMA_HOST}/api/{endpoint}",
+        data=json.dumps(payload).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(req) as resp:
+        for line in resp:
+            if line.strip():
+                yield json.loads(line)
+
+
 def nix(run):
     return shlex.join([
         "nix-shell",
@@ -59,12 +190,128 @@ def nix(run):
     ])
 
 
+class PrefetchJob:
+    def __init__(self, cmd, cwd):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.proc = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            if self.cancelled:
+                return None
+            self.proc = subprocess.Popen(
+                self.cmd,
+                shell=True,
+                cwd=self.cwd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        with trace.span(
+            self.cmd, "spawn", cwd=self.cwd, keypress=trace.keypresses, prefetch=True
+        ) as info:
+            out = self.proc.stdout.read(PREFETCH_MAX + 1)
+            if len(out) > PREFETCH_MAX:
+                self.cancel()
+            self.proc.stdout.close()
+            info["exit"] = self.proc.wait()
+            info["bytes"] = len(out)
+        if self.cancelled:
+            return None
+        return out
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.proc and self.proc.poll() is None:
+                os.killpg(self.proc.pid, signal.SIGTERM)
+
+
+class Prefetcher:
+    """
+    Compute the input of the likely next filter verbs in the background
+    """
+
+    instances = weakref.WeakSet()
+
+    def __init__(self):
+        self.jobs = {}
+        self.instances.add(self)
+
+    def submit(self, job):
+        # Daemon threads, so exiting never waits for a pipeline to finish
+        future = Future()
+
+        def run():
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(job())
+                except Exception as exc:
+                    future.set_exception(exc)
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    def cancel(self):
+        for job, future in self.jobs.values():
+            future.cancel()
+            job.cancel()
+        self.jobs = {}
+
+    def schedule(self, app):
+        self.cancel()
+        # Outside of git the inputs are finds over possibly huge trees
+        if not app.git:
+            return
+        for verb in inheritors(FilterVerb):
+            verb_obj = verb(app)
+            if not verb.prefetch or not verb_obj.show():
+                continue
+            key = (verb_obj.input_command, verb_obj.input_cwd)
+            if key not in self.jobs:
+                job = PrefetchJob(*key)
+                self.jobs[key] = (job, self.submit(job))
+
+    def result(self, cmd, cwd):
+        """
+        Output of a finished job, None if there is none. An unfinished job is
+        cancelled, piping the command into fzf shows results sooner than
+        waiting for all of it.
+        """
+        try:
+            job, future = self.jobs.pop((cmd, cwd))
+        except KeyError:
+            return None
+        if not future.done():
+            future.cancel()
+            job.cancel()
+            return None
+        if future.cancelled() or future.exception():
+            return None
+        return future.result()
+
+
+@atexit.register
+def cancel_prefetch():
+    for prefetcher in list(Prefetcher.instances):
+        prefetcher.cancel()
+
+
 class AppGUIMixin:
     arrow = 0
     query = None
     nothing_pressed_yet = True
 
     def _draw(self, stdscr, verbs):
+        # Only the drawing, not the wait for the key
+        with trace.span("redraw", "draw", verbs=len(verbs)):
+            self._render(stdscr, verbs)
+        return stdscr.getkey()
+
+    def _render(self, stdscr, verbs):
         # Clear screen
         stdscr.clear()
 
@@ -109,13 +356,21 @@ class AppGUIMixin:
             c += 1
             stdscr.addstr(c, pad_left, "")
 
-        curses.curs_set(0)
-
         stdscr.refresh()
-        return stdscr.getkey()
+
+    def screen(self, func, *args, **kwargs):
+        """
+        Call func with a screen to draw on, a curses window here
+        """
+
+        def hidden_cursor(stdscr, *args, **kwargs):
+            curses.curs_set(0)
+            return func(stdscr, *args, **kwargs)
+
+        return wrapper(hidden_cursor, *args, **kwargs)
 
     def draw(self, *args, **kwargs):
-        return wrapper(self._draw, *args, **kwargs)
+        return self.screen(self._draw, *args, **kwargs)
 
     def _flicker(self, stdscr):
         stdscr.clear()
@@ -126,7 +381,29 @@ class AppGUIMixin:
         sleep(0.05)
 
     def flicker(self, *args, **kwargs):
-        return wrapper(self._flicker, *args, **kwargs)
+        return self.screen(self._flicker, *args, **kwargs)
+
+    def _page(self, stdscr, lines):
+        top = 0
+        while True:
+            stdscr.clear()
+            rows, cols = stdscr.getmaxyx()
+            for row, line in enumerate(lines[top : top + rows - 2]):
+                stdscr.addstr(row + 1, 1, line[: cols - 2])
+            stdscr.refresh()
+            key = stdscr.getkey()
+            if key in ("j", "KEY_DOWN"):
+                top = min(top + 1, max(len(lines) - 1, 0))
+            elif key in ("k", "KEY_UP"):
+                top = max(top - 1, 0)
+            else:
+                return
+
+    def page(self, lines):
+        """
+        Show lines, scroll with j and k, any other key returns
+        """
+        return self.screen(self._page, lines)
 
     def _main(self):
         while True:
@@ -142,8 +419,9 @@ class AppGUIMixin:
             # HACK: Enable a shortcut but hitting spaces two times
             #
             key = self.draw(verbs)
+            trace.keypresses += 1
             if key == " " and self.nothing_pressed_yet:
-                CdGitRootVerb(self)()
+                self.call(CdGitRootVerb(self))
                 self.nothing_pressed_yet = False
                 continue
             self.nothing_pressed_yet = False
@@ -153,23 +431,23 @@ class AppGUIMixin:
             elif key in ("k", "KEY_UP"):
                 self.arrow = max(self.arrow - 1, 0)
             elif key == "\n":
-                verb = self.arrow_at
-                try:
-                    verb()
-                except subprocess.CalledProcessError as exc:
-                    print(exc)
+                self.call(self.arrow_at)
             else:
                 keyfound = False
                 for verb in verbs:
                     if verb.map == key:
                         keyfound = True
-                        try:
-                            verb()
-                        except subprocess.CalledProcessError as exc:
-                            print(exc)
+                        self.call(verb)
                 if not keyfound:
                     self.flicker()
 
+    def call(self, verb):
+        with trace.span(verb.__class__.__name__, "verb", map=verb.map):
+            try:
+                verb()
+            except subprocess.CalledProcessError as exc:
+                print(exc)
+
     def main(self):
         try:
             self._main()
@@ -178,16 +456,141 @@ class AppGUIMixin:
             self.close()
 
     def close(self):
+        self.prefetcher.cancel()
         self.savehist()
+        trace.save()
         self.run("nvr +FloatClose", shell=True)
 
 
+def fuzzy_score(query, text):
+    """
+    Score a fzf-like subsequence match of `query` in `text`, None if no match
+    """
+    score = 0
+    pos = -1
+    for char in query:
+        found = text.find(char, pos + 1)
+        if found == -1:
+            return None
+        if found == pos + 1:
+            score += 3
+        elif found == 0 or text[found - 1] in "/_-. ":
+            score += 2
+        else:
+            score -= 1
+        pos = found
+    return score
+
+
+class FuzzyPicker:
+    """
+    In-process replacement for fzf, for short candidate lists. Each key
+    scans the previous matches linearly.
+    """
+
+    def __init__(self, lines, query="", accept=("\n",)):
+        self.lines = lines
+        self.lower = [line.lower() for line in lines]
+        self.accept = accept
+        self.arrow = 0
+        self.query = ""
+        # Matching indices for each query prefix, so typing only narrows the
+        # previous result and backspace is free
+        self.matches = [array("l", range(len(lines)))]
+        self.scores = [array("l", [0]) * len(lines)]
+        for char in query:
+            self.push(char)
+
+    def push(self, char):
+        self.query += char
+        query = self.query.lower()
+        indices = array("l")
+        scores = array("l")
+        for i in self.matches[-1]:
+            score = fuzzy_score(query, self.lower[i])
+            if score is not None:
+                indices.append(i)
+                scores.append(score)
+        self.matches.append(indices)
+        self.scores.append(scores)
+        self.arrow = 0
+
+    def pop(self):
+        if self.query:
+            self.query = self.query[:-1]
+            self.matches.pop()
+            self.scores.pop()
+            self.arrow = 0
+
+    def ranked(self):
+        if not self.query:
+            return list(self.matches[-1])
+        # Best score first, shorter lines win ties like in fzf
+        return [
+            i
+            for _, i in sorted(
+                zip(self.scores[-1], self.matches[-1]),
+                key=lambda m: (-m[0], len(self.lines[m[1]])),
+            )
+        ]
+
+    def _pick(self, stdscr):
+        while True:
+            stdscr.clear()
+            rows, cols = stdscr.getmaxyx()
+            ranked = self.ranked()
+            stdscr.addstr(1, 1, f"> {self.query}"[: cols - 2])
+            stdscr.addstr(
+                2, 1, f"  {len(ranked)}/{len(self.lines)}"[: cols - 2], curses.A_DIM
+            )
+            for row, i in enumerate(ranked[: max(rows - 4, 0)]):
+                a = "*" if row == self.arrow else " "
+                stdscr.addstr(row + 3, 1, f"{a} {self.lines[i]}"[: cols - 2])
+            stdscr.refresh()
+
+            key = stdscr.getkey()
+            if key in self.accept:
+                return self.lines[ranked[self.arrow]] if ranked else None
+            elif key in ("\x1b", "\x03", "\x07"):
+                return None
+            elif key in ("KEY_BACKSPACE", "\x7f", "\b"):
+                self.pop()
+            elif key in ("KEY_DOWN", "\x0e"):
+                self.arrow = min(self.arrow + 1, max(len(ranked) - 1, 0))
+            elif key in ("KEY_UP", "\x10"):
+                self.arrow = max(self.arrow - 1, 0)
+            elif len(key) == 1 and key.isprintable():
+                self.push(key)
+
+    def pick(self, screen):
+        try:
+            return screen(self._pick)
+        except KeyboardInterrupt:
+            return None
+
+
 class App(AppGUIMixin):
     def __init__(self):
         self.maps = {}
         self.hist = []
         self.path = None
         self.dir = None
+        self.prefetcher = Prefetcher()
+        self._background = None
+
+    def background(self):
+        """
+        vim's &background, asked once when first needed
+        """
+        if self._background is None:
+            self._background = self.vim_eval("&background")
+        return self._background
+
+    def env(self):
+        """
+        Environment variables for commands that show files with bat
+        """
+        return {"BAT_THEME": f"Solarized ({self.background()})"}
 
     def savehist(self):
         Path("~/.verbs_hist").expanduser().write_text(json.dumps(list((self.hist))))
@@ -223,21 +626,77 @@ class App(AppGUIMixin):
             )
         except subprocess.CalledProcessError:
             self.git = None
+        if PREFETCH:
+            self.prefetcher.schedule(self)
 
     def output(self, *args, **kwargs):
         kwargs.setdefault("cwd", self.dir)
-        resp = subprocess.check_output(*args, **kwargs)
+        resp = check_output(*args, **kwargs)
         return resp.decode().strip("\n")
 
+    def interactive(self, cmd, cwd=None, input=None):
+        """
+        Output of a shell command that needs the terminal, like fzf
+        """
+        return self.output(
+            cmd,
+            shell=True,
+            cwd=cwd or self.dir,
+            input=input,
+            env=dict(os.environ, **self.env()),
+        )
+
     def run(self, *args, anykey=False, **kwargs):
         kwargs.setdefault("cwd", self.dir)
-        subprocess.Popen(*args, **kwargs).wait()
+        kwargs.setdefault("env", dict(os.environ, **self.env()))
+        with trace.span(
+            cmd_repr(args[0]), "spawn", cwd=kwargs["cwd"], keypress=trace.keypresses
+        ) as info:
+            info["exit"] = subprocess.Popen(*args, **kwargs).wait()
         if anykey:
-            self.run([
-                "/bin/bash",
-                "-c",
-                "read -rsp $'Press any key to continue...\n' -n1 key",
+            self.anykey()
+
+    def anykey(self):
+        print("Press any key to continue...", flush=True)
+        fd = sys.stdin.fileno()
+        try:
+            old = termios.tcgetattr(fd)
+        except termios.error:
+            return
+        try:
+            tty.setcbreak(fd)
+            os.read(fd, 1)
+        finally:
+            termios.tcsetattr(fd, termios.TCSADRAIN, old)
+
+    def edit(self, locations):
+        """
+        Open (file, line) locations in vim as buffers and a quickfix list,
+        with a single vim command
+        """
+
+        def vimstr(obj):
+            return "'{}'".format(json.dumps(obj).replace("'", "''"))
+
+        items = [{"filename": file, "lnum": int(line)} for file, line in locations]
+        files = [file for file, _ in locations]
+        self.vim(
+            " | ".join([
+                "wincmd p",
+                f"for f in json_decode({vimstr(files)})",
+                "execute 'badd ' . fnameescape(f)",
+                "endfor",
+                "call setqflist([], ' ', {'title': 'verbs', "
+                f"'items': json_decode({vimstr(items)})}})",
+                "cfirst",
             ])
+        )
+
+    def vim(self, command):
+        self.run(["nvr", "-c", command])
+
+    def vim_eval(self, expr):
+        return self.output(["nvr", "--remote-expr", expr])
 
     def outputgo(self, *args, **kwargs):
         kwargs.setdefault("cwd", self.dir)
@@ -253,6 +712,174 @@ class App(AppGUIMixin):
             return self.path
 
 
+class NvimScreen:
+    """
+    The subset of the curses window api used here, drawn into a neovim buffer
+    """
+
+    # keytrans() names of the keys the curses code knows by another name
+    keys = {
+        "<CR>": "\n",
+        "<Space>": " ",
+        "<Tab>": "\t",
+        "<Esc>": "\x1b",
+        "<lt>": "<",
+        "<Down>": "KEY_DOWN",
+        "<Up>": "KEY_UP",
+        "<BS>": "KEY_BACKSPACE",
+        "<C-N>": "\x0e",
+        "<C-P>": "\x10",
+        "<C-G>": "\x07",
+    }
+
+    def __init__(self, nvim, buf, win):
+        self.nvim = nvim
+        self.buf = buf
+        self.win = win
+        self.lines = []
+
+    def getmaxyx(self):
+        return (
+            self.nvim.api.win_get_height(self.win),
+            self.nvim.api.win_get_width(self.win),
+        )
+
+    def clear(self):
+        self.lines = []
+
+    def addstr(self, row, col, text, attr=None):
+        while len(self.lines) <= row:
+            self.lines.append("")
+        line = self.lines[row].ljust(col)
+        self.lines[row] = line[:col] + text + line[col + len(text) :]
+
+    def refresh(self):
+        self.nvim.api.buf_set_lines(self.buf, 0, -1, False, self.lines)
+        self.nvim.command("redraw")
+
+    def getkey(self):
+        # Special keys from getcharstr() aren't valid utf-8, so they are
+        # translated to key notation before crossing the rpc connection
+        key = self.nvim.eval("keytrans(getcharstr())")
+        if key == "<C-C>":
+            raise KeyboardInterrupt
+        return self.keys.get(key, key)
+
+
+class NvimGUIMixin(AppGUIMixin):
+    """
+    Draw the menu into a floating scratch buffer over neovim's rpc api,
+    instead of curses in a terminal. Start it as a job from neovim with
+    VERBS_FRONTEND=nvim, it connects back through $NVIM.
+    """
+
+    nvim = None
+    win = None
+
+    def connect(self):
+        import pynvim
+
+        self.nvim = pynvim.attach(
+            "socket", path=os.environ.get("NVIM") or os.environ["NVIM_LISTEN_ADDRESS"]
+        )
+
+    def open_float(self):
+        columns = self.nvim.options["columns"]
+        lines = self.nvim.options["lines"]
+        width = max(columns * 8 // 10, 1)
+        height = max(lines * 8 // 10, 1)
+        self.buf = self.nvim.api.create_buf(False, True)
+        self.win = self.nvim.api.open_win(
+            self.buf,
+            True,
+            {
+                "relative": "editor",
+                "width": width,
+                "height": height,
+                "row": (lines - height) // 2,
+                "col": (columns - width) // 2,
+                "style": "minimal",
+                "border": "rounded",
+            },
+        )
+
+    def screen(self, func, *args, **kwargs):
+        if self.win is None:
+            self.open_float()
+        return func(NvimScreen(self.nvim, self.buf, self.win), *args, **kwargs)
+
+    def terminal(self, cmd, cwd, anykey=False):
+        """
+        Run cmd in a terminal buffer in the float and wait for it to exit
+        """
+        if self.win is None:
+            self.open_float()
+        term = self.nvim.api.create_buf(False, True)
+        self.nvim.api.win_set_buf(self.win, term)
+        job = self.nvim.call("termopen", cmd, {"cwd": cwd, "env": self.env()})
+        self.nvim.command("startinsert")
+        while True:
+            (code,) = self.nvim.call("jobwait", [job], 0)
+            if code != -1:
+                break
+            sleep(0.02)
+        if anykey:
+            self.nvim.command("stopinsert")
+            self.nvim.out_write("Press any key to continue...\n")
+            self.nvim.eval("keytrans(getcharstr())")
+        self.nvim.api.win_set_buf(self.win, self.buf)
+        self.nvim.command(f"bwipeout! {term.number}")
+        return code
+
+    def interactive(self, cmd, cwd=None, input=None):
+        import tempfile
+
+        cwd = cwd or self.dir
+        with tempfile.TemporaryDirectory() as tmp:
+            stdin = os.path.join(tmp, "in")
+            stdout = os.path.join(tmp, "out")
+            if input is not None:
+                Path(stdin).write_bytes(input)
+                cmd = f"{{ {cmd}; }} < {shlex.quote(stdin)}"
+            code = self.terminal(f"{{ {cmd}; }} > {shlex.quote(stdout)}", cwd)
+            if code:
+                raise subprocess.CalledProcessError(code, cmd)
+            return Path(stdout).read_text().strip("\n")
+
+    def run(self, args, anykey=False, shell=False, cwd=None):
+        cwd = cwd or self.dir
+        with trace.span(
+            cmd_repr(args), "spawn", cwd=cwd, keypress=trace.keypresses
+        ) as info:
+            info["exit"] = self.terminal(args, cwd, anykey)
+
+    def vim(self, command):
+        with trace.span(command, "rpc"):
+            self.nvim.command(command)
+
+    def vim_eval(self, expr):
+        with trace.span(expr, "rpc"):
+            return str(self.nvim.eval(expr))
+
+    def close(self):
+        self.prefetcher.cancel()
+        self.savehist()
+        trace.save()
+        if self.win is not None:
+            self.nvim.api.win_close(self.win, True)
+        sys.exit()
+
+
+class NvimApp(NvimGUIMixin, App):
+    def __init__(self, nvim=None):
+        super().__init__()
+        # Connected right away, main() may ask vim for its cwd before drawing
+        if nvim is None:
+            self.connect()
+        else:
+            self.nvim = nvim
+
+
 class ShowIfGitMixin:
     def show(self):
         return self.app.git
@@ -282,35 +909,64 @@ class Verb:
 
 
 class CommandVerb(Verb):
+    """
+    Run the `vim` command in neovim, `argv` directly, or `command` through
+    the shell when it needs pipes and the like. All are formatted with
+    {path}, {line}, {dir}, {pdir} and {relpath}, escaped for vim and the
+    shell.
+    """
+
     anykey = False
     close = False
     category = "command"
     close = True
+    argv = None
+    vim = None
 
     @property
     def help(self):
+        if self.vim:
+            return f"`:{self.vim}`"
+        if self.argv:
+            return f"`{shlex.join(self.argv)}`"
         return f"`{self.command}`"
 
-    def __call__(self):
-        path = shlex.quote(self.app.path)
-        dir = shlex.quote(self.app.dir)
+    def placeholders(self):
         if self.app.git:
-            pdir = shlex.quote(os.path.basename(self.app.git))
+            pdir = os.path.basename(self.app.git)
+            relpath = os.path.relpath(self.app.path, start=self.app.git)
         else:
             pdir = ""
-        line = shlex.quote(self.app.line or "0")
-
-        if self.app.git:
-            relpath = shlex.quote(os.path.relpath(self.app.path, start=self.app.git))
-        else:
             relpath = ""
-        self.app.run(
-            self.command.format(
-                path=path, line=line, dir=dir, pdir=pdir, relpath=relpath
-            ),
-            shell=True,
-            anykey=self.anykey,
+        return dict(
+            path=self.app.path,
+            line=str(self.app.line or "0"),
+            dir=self.app.dir,
+            pdir=pdir,
+            relpath=relpath,
         )
+
+    def __call__(self):
+        placeholders = self.placeholders()
+        if self.vim:
+            self.app.vim(
+                self.vim.format(
+                    **{k: fnameescape(v) for k, v in placeholders.items()}
+                )
+            )
+        elif self.argv:
+            self.app.run(
+                [arg.format(**placeholders) for arg in self.argv],
+                anykey=self.anykey,
+            )
+        else:
+            self.app.run(
+                self.command.format(
+                    **{k: shlex.quote(v) if v else "" for k, v in placeholders.items()}
+                ),
+                shell=True,
+                anykey=self.anykey,
+            )
         if self.close:
             self.app.close()
 
@@ -371,7 +1027,7 @@ class CdVimVerb(Verb):
 
     @property
     def _vimcwd(self):
-        return self.app.output("nvr --remote-expr 'getcwd()'", shell=True)
+        return self.app.vim_eval("getcwd()")
 
     help = "vim cwd"
 
@@ -391,9 +1047,195 @@ class CdGitRootVerb(Verb):
         self.app.go(self.app.git)
 
 
+class BlameCache:
+    """
+    git blame and git log -L results of a file, cached on disk by its repo,
+    path and the ids of its committed and working tree blobs
+    """
+
+    # Cache files with a git blame --incremental running for them
+    streaming = set()
+
+    def __init__(self, app):
+        self.git = app.git
+        self.relpath = os.path.relpath(app.path, start=app.git)
+        # Fails for files that are not committed yet
+        committed = app.output(
+            ["git", "rev-parse", f"HEAD:{self.relpath}"],
+            cwd=self.git,
+            stderr=subprocess.DEVNULL,
+        )
+        worktree = app.output(["git", "hash-object", "--", app.path], cwd=self.git)
+        # Identical files elsewhere have the same blobs but not the same history
+        self.location = hashlib.sha1(f"{self.git}\0{self.relpath}".encode()).hexdigest()
+        self.file = CACHE_DIR / "blame" / f"{self.location}-{committed}-{worktree}.json"
+        self.data = self.load()
+
+    def load(self):
+        try:
+            return json.loads(self.file.read_text())
+        except FileNotFoundError:
+            return {"lines": {}, "commits": {}, "log": {}, "complete": False}
+
+    def save(self):
+        # Merge with what other instances wrote since we loaded
+        data = self.load()
+        data["lines"].update(self.data["lines"])
+        data["commits"].update(self.data["commits"])
+        data["log"].update(self.data["log"])
+        data["complete"] = data["complete"] or self.data["complete"]
+        self.data = data
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        if not self.file.exists():
+            # Only the current version of a file is worth keeping
+            for old in self.file.parent.glob(f"{self.location}-*.json"):
+                old.unlink(missing_ok=True)
+        tmp = self.file.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps(data))
+        os.replace(tmp, self.file)
+
+    def feed(self, stream, data):
+        """
+        Read git blame --porcelain or --incremental output into data
+        """
+        lines = data["lines"]
+        commits = data["commits"]
+        sha = None
+        for line in stream:
+            if line.startswith("\t"):
+                continue
+            key, _, value = line.rstrip("\n").partition(" ")
+            header = value.split()
+            if len(key) in (40, 64) and len(header) >= 2 and header[0].isdigit():
+                sha = key
+                final = int(header[1])
+                count = int(header[2]) if len(header) > 2 else 1
+                for i in range(final, final + count):
+                    lines[str(i)] = sha
+                commits.setdefault(sha, {})
+            elif sha:
+                commits[sha].setdefault(key, value)
+
+    def stream(self):
+        # Collected separately so saving meanwhile never sees a changing dict
+        full = {"lines": {}, "commits": {}}
+        with trace.span(
+            f"git blame --incremental {self.relpath}",
+            "spawn",
+            cwd=self.git,
+            keypress=trace.keypresses,
+        ) as info:
+            proc = subprocess.Popen(
+                ["git", "blame", "--incremental", "--", self.relpath],
+                cwd=self.git,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+            )
+            self.feed(proc.stdout, full)
+            info["exit"] = proc.wait()
+        if proc.returncode == 0:
+            self.data.update(full, complete=True)
+            self.save()
+        self.streaming.discard(self.file)
+
+    def blame(self, first, last):
+        """
+        Blame for the lines first to last, the rest of the file is blamed in
+        the background afterwards
+        """
+        wanted = [str(i) for i in range(first, last + 1)]
+        if not all(i in self.data["lines"] for i in wanted):
+            self.feed(
+                check_output(
+                    [
+                        "git",
+                        "blame",
+                        "--porcelain",
+                        "-L",
+                        f"{first},{last}",
+                        "--",
+                        self.relpath,
+                    ],
+                    cwd=self.git,
+                )
+                .decode(errors="replace")
+                .splitlines(),
+                self.data,
+            )
+            self.save()
+        if not self.data["complete"] and self.file not in self.streaming:
+            self.streaming.add(self.file)
+            threading.Thread(target=self.stream, daemon=True).start()
+        return [(int(i), self.data["lines"].get(i)) for i in wanted]
+
+    def log(self, first, last):
+        key = f"{first},{last}"
+        if key not in self.data["log"]:
+            self.data["log"][key] = check_output(
+                ["git", "log", "--no-color", "-L", f"{key}:{self.relpath}"],
+                cwd=self.git,
+            ).decode(errors="replace")
+            self.save()
+        return self.data["log"][key]
+
+    def describe(self, line, sha):
+        commit = self.data["commits"].get(sha, {})
+        date = strftime("%Y-%m-%d", localtime(int(commit.get("author-time", 0))))
+        return (
+            f"{line:>5} {(sha or '?')[:8]} {commit.get('author', '?'):<16.16}"
+            f" {date} {commit.get('summary', '')}"
+        )
+
+
+class BlameVerb(ShowIfFileMixin, Verb):
+    map = "B"
+    help = "blame"
+    category = "file"
+
+    def show(self):
+        return self.app.git and super().show()
+
+    def lines(self):
+        if self.app.range:
+            return self.app.range
+        line = int(self.app.line or 1)
+        return line, line
+
+    def cache(self):
+        try:
+            return BlameCache(self.app)
+        except subprocess.CalledProcessError:
+            self.app.page([f"{self.app.path} has no committed history"])
+            return None
+
+    def __call__(self):
+        cache = self.cache()
+        if cache is None:
+            return
+        self.app.page(
+            [f"blame {cache.relpath}", ""]
+            + [cache.describe(line, sha) for line, sha in cache.blame(*self.lines())]
+        )
+
+
+class LogRangeVerb(BlameVerb):
+    map = "L"
+    help = "line history"
+
+    def show(self):
+        return (self.app.line or self.app.range) and super().show()
+
+    def __call__(self):
+        cache = self.cache()
+        if cache is None:
+            return
+        self.app.page(cache.log(*self.lines()).splitlines())
+
+
 class RunLazygitVerb(ShowIfGitMixin, CommandVerb):
     map = "g"
-    command = "lazygit"
+    argv = ["lazygit"]
 
 
 class RunLessVerb(ShowIfFileMixin, CommandVerb):
@@ -420,18 +1262,18 @@ class RunSCommit(CommandVerb):
 
 class RunBashVerb(CommandVerb):
     map = "s"
-    command = "bash"
+    argv = ["bash"]
     # help = 'Open shell here'
 
 
 class RunGitDiffVerb(ShowIfGitMixin, CommandVerb):
     map = "d"
-    command = "git diff"
+    argv = ["git", "diff"]
 
 
 class RunEditVerb(ShowIfFileMixin, CommandVerb):
     map = " "
-    command = "nvr +'wincmd p | e {path} | {line}'"
+    vim = "wincmd p | e {path} | {line}"
     help = "Edit"
     close = True
     category = "file"
@@ -449,7 +1291,7 @@ class RunEditVerb(ShowIfFileMixin, CommandVerb):
 
 class SetVimVerb(ShowIfDirMixin, CommandVerb):
     map = "V"
-    command = "nvr -c 'cd {dir}'"
+    vim = "cd {dir}"
     help = "Set vim cwd"
 
 
@@ -459,9 +1301,21 @@ class RunLastCommandVerb(CommandVerb):
 
     @property
     def command(self):
-        return self.app.output(
-            "cat ~/.bash_eternal_history  | tail -n 1", shell=True
-        ).strip()
+        try:
+            with open(os.path.expanduser("~/.bash_eternal_history"), "rb") as f:
+                # The last line is all we need, read backwards until a newline
+                # before it shows up instead of reading the whole history
+                end = f.seek(0, os.SEEK_END)
+                start = end
+                tail = b""
+                while start > 0 and b"\n" not in tail.strip():
+                    start = max(start - 4096, 0)
+                    f.seek(start)
+                    tail = f.read(end - start)
+        except FileNotFoundError:
+            return ""
+        lines = tail.decode(errors="replace").strip().splitlines()
+        return lines[-1].strip() if lines else ""
 
     @property
     def help(self):
@@ -473,9 +1327,13 @@ class FilterVerb(Verb):
     space_return = True
     cwd = None
     category = "filter"
+    prefetch = False
+    builtin_picker = False
+    multi = False
 
     fzf = {
-        "color": f"{background()},bg+:{'#073642' if background() == 'dark' else '#eee8d5'}",
+        # Filled in from vim's background by fzf_command()
+        "color": "{background},bg+:{highlight}",
         "no-separator": True,
         "no-scrollbar": True,
     }
@@ -484,6 +1342,37 @@ class FilterVerb(Verb):
         return stri
 
     def __call__(self):
+        candidates = self.app.prefetcher.result(self.input_command, self.input_cwd)
+
+        # The built-in picker has no preview pane
+        if self.builtin_picker and "preview" not in self.fzf:
+            if candidates is None:
+                candidates = check_output(
+                    self.input_command, shell=True, cwd=self.input_cwd
+                )
+            lines = candidates.decode().splitlines()
+            if len(lines) <= BUILTIN_PICKER_MAX:
+                self.pick(lines)
+                return
+
+        fzf_cmd = self.fzf_command()
+        if candidates is None:
+            out = self.app.interactive(
+                f"{self.input_command} | {fzf_cmd}", cwd=self.input_cwd
+            )
+        else:
+            out = self.app.interactive(fzf_cmd, cwd=self.input_cwd, input=candidates)
+        self._handle(out)
+
+    def pick(self, lines):
+        accept = ("\n", " ") if self.space_return else ("\n",)
+        query = self.app.query if self.fill_query and self.app.query else ""
+        with trace.span("picker", "draw", candidates=len(lines)):
+            match = FuzzyPicker(lines, query, accept).pick(self.app.screen)
+        if match is not None:
+            self._handle(match)
+
+    def fzf_command(self):
         fzf = ["fzf"]
         fzf_opts = self.fzf.copy()
 
@@ -493,6 +1382,16 @@ class FilterVerb(Verb):
         if self.fill_query and self.app.query:
             fzf_opts["query"] = self.app.query
 
+        if self.multi:
+            fzf_opts["multi"] = True
+
+        if "color" in fzf_opts:
+            background = self.app.background()
+            fzf_opts["color"] = fzf_opts["color"].format(
+                background=background,
+                highlight="#073642" if background == "dark" else "#eee8d5",
+            )
+
         for key, val in fzf_opts.items():
             key = key.replace("_", "-")
             if val is True:
@@ -500,22 +1399,37 @@ class FilterVerb(Verb):
             else:
                 fzf.append(f"--{key}={val}")
 
-        fzf_cmd = shlex.join(fzf)
+        return shlex.join(fzf)
+
+    @property
+    def input_command(self):
         if self.command:
-            cmd = f"{self.files_command} | {self.command} | {fzf_cmd}"
-        else:
-            cmd = f"{self.files_command} | {fzf_cmd}"
+            return f"{self.files_command} | {self.command}"
+        return self.files_command
 
-        if self.cwd is None:
-            out = self.app.output(cmd, shell=True)
-        else:
-            out = self.app.output(cmd, shell=True, cwd=self.cwd)
-        self._handle(out)
+    @property
+    def input_cwd(self):
+        return self.cwd or self.app.dir
 
     def _handle(self, match):
+        # Drop the --expect key line
+        selected = [i for i in match.split("\n") if i.strip()]
+        if self.multi and len(selected) > 1:
+            self.handle_multi(selected)
+            return
         select = match.split("\n")[-1]
         self.handle(select)
 
+    def handle_multi(self, matches):
+        self.app.edit([
+            (os.path.join(self.input_cwd, file), line)
+            for file, line in map(self.location, matches)
+        ])
+        self.app.close()
+
+    def location(self, match):
+        return match, 1
+
     def handle(self, match):
         self.app.go(match)
 
@@ -580,15 +1494,22 @@ class FindLines(FilterVerb):
 
     command = "xargs -L1 grep --line-number --with-filename . 2> /dev/null"
 
-    def handle(self, match):
+    multi = True
+
+    def location(self, match):
         file, line, _ = match.split(":", 2)
-        self.app.go(file, line)
+        return file, line
+
+    def handle(self, match):
+        self.app.go(*self.location(match))
 
 
 class FilterFilesVerb(FilterVerb):
     fill_query = False
     help = "files"
     map = "f"
+    prefetch = True
+    multi = True
 
     @property
     def fzf(self):
@@ -613,16 +1534,19 @@ class FilterVimBufferVerb(FilterVerb):
     fill_query = False
     help = "vim buffers"
     map = "b"
+    builtin_picker = True
     fzf = dict(ansi=True)
     command = "grep -v '^term://'"
-    files_command = "nvr --remote-expr {}".format(
-        shlex.quote(
+
+    @property
+    def files_command(self):
+        buffers = self.app.vim_eval(
             """join(filter(map(range(1,bufnr('$')), 'bufname(v:val)'), 'buflisted(v:val)'), '\n')"""
         )
-    )
+        return shlex.join(["printf", "%s\\n", *buffers.splitlines()])
 
     def handle(self, match):
-        vimcur = self.app.output("nvr --remote-expr 'getcwd()'", shell=True)
+        vimcur = self.app.vim_eval("getcwd()")
         real = os.path.join(vimcur, match)
         self.app.go(real)
 
@@ -630,6 +1554,7 @@ class FilterVimBufferVerb(FilterVerb):
 class FilterTagsVerb(FilterVerb):
     map = "t"
     help = "tags"
+    prefetch = True
     fzf = dict(
         exact=True,
         delimiter="\t",
@@ -642,19 +1567,22 @@ class FilterTagsVerb(FilterVerb):
     )
 
     command = nix("xargs ctags --excmd=number -f - ")
+    multi = True
 
-    def handle(self, match):
+    def location(self, match):
         i = match.split("\t")
-        file = i[1]
-        line = i[2]
-        self.app.query = i[0]
-        self.app.go(file, line.strip(';"'))
+        return i[1], i[2].strip(';"')
+
+    def handle(self, match):
+        self.app.query = match.split("\t")[0]
+        self.app.go(*self.location(match))
 
 
 class FilterRecentVerb(FilterVerb, ShowIfGitMixin):
     fill_query = False
     map = "r"
     help = "changed files"
+    prefetch = True
     command = "sort | uniq"
     fzf = dict(
         preview="git diff main {} | " + bat(lines=False),
@@ -708,6 +1636,47 @@ class PromptVerb(Verb):
         {% endif %}
         """).strip("\n ")
 
+    # Same context, but ordered from least to most likely to change between
+    # requests, so ollama can reuse the KV cache of the common prefix.
+    stable_prompt_template = textwrap.dedent("""
+        {% for file in project_files|sort %}
+        # {{file}}
+        ```
+        {{file|cat}}
+        ```
+        {% endfor %}
+
+        {% if include_open_file %}
+        # {{open_file}}
+        ```
+        {{open_file|cat}}
+        ```
+        {% endif %}
+
+        {% if selection and include_selection %}
+        Selected code:
+        ```
+        {{selection}}
+        ```
+        {% endif %}
+
+        {{user_prompt}}
+
+        {% if dont_think %}
+        /no_think
+        {% endif %}
+        """).strip("\n ")
+
+    models = [
+        "ollama/qwen3:0.6b",
+        "ollama/qwen3:1.7b",
+        "ollama/qwen3:4b",
+        "ollama/qwen3:8b",
+        "ollama/qwen3:14b",
+    ]
+    default_model = "ollama/qwen3:4b"
+    keep_alive = "30m"
+
     def show(self):
         # return self.app.range
         return True
@@ -716,6 +1685,49 @@ class PromptVerb(Verb):
         with open(file) as f:
             return f.read()
 
+    def preload(self, model):
+        # An empty generate request loads the model and keeps it in memory
+        if model.startswith("ollama/"):
+            try:
+                for _ in ollama(
+                    "generate",
+                    {"model": model[len("ollama/") :], "keep_alive": self.keep_alive},
+                ):
+                    pass
+            except OSError as exc:
+                print(exc, file=sys.stderr)
+
+    def render_prompt(self, stable_prefix, **context):
+        import jinja2
+
+        env = jinja2.Environment()
+        env.filters["cat"] = self.cat
+        if stable_prefix:
+            template = env.from_string(self.stable_prompt_template)
+        else:
+            template = env.from_string(self.prompt_template)
+        return template.render(open_file=self.app.path, **context)
+
+    def stream_stable(self, model, temperature, top_p, prompt):
+        resp = ""
+        for part in ollama(
+            "chat",
+            {
+                "model": model[len("ollama/") :],
+                "messages": [{"content": prompt, "role": "user"}],
+                "options": {"temperature": temperature, "top_p": top_p},
+                "keep_alive": self.keep_alive,
+                "stream": True,
+            },
+        ):
+            resp += part.get("message", {}).get("content", "")
+            if part.get("done"):
+                # ollama only evaluates the prompt tokens missing from its
+                # cache, so this drops when the prefix was reused
+                evaluated = part.get("prompt_eval_count", 0)
+                resp += f"\n\n[prompt tokens evaluated: {evaluated}]"
+            yield resp
+
     def submit(
         self,
         model,
@@ -724,12 +1736,12 @@ class PromptVerb(Verb):
         include_selection,
         include_open_file,
         dont_think,
+        stable_prefix,
         project_files,
         user_prompt,
         echo_generated_prompt,
     ):
         from litellm import completion
-        import jinja2
         import gradio as gr
 
         if self.app.range:
@@ -739,17 +1751,25 @@ class PromptVerb(Verb):
         else:
             selection = ""
 
-        env = jinja2.Environment()
-        env.filters["cat"] = self.cat
-        template = env.from_string(self.prompt_template)
-        prompt = template.render(
-            open_file=self.app.path,
-            **{k: v for (k, v) in locals().items() if k != "self"},
+        prompt = self.render_prompt(
+            stable_prefix,
+            **{
+                k: v
+                for (k, v) in locals().items()
+                if k not in ("self", "stable_prefix")
+            },
         )
 
         if echo_generated_prompt:
             yield (gr.Textbox(value=prompt), gr.Button(value="Apply", size="sm"))
 
+        elif stable_prefix and model.startswith("ollama/"):
+            for resp in self.stream_stable(model, temperature, top_p, prompt):
+                yield (
+                    gr.Textbox(value=resp),
+                    gr.Button(value="Apply", size="sm"),
+                )
+
         else:
             response = completion(
                 model=model,
@@ -779,21 +1799,20 @@ class PromptVerb(Verb):
         import gradio as gr
 
         project_files = (
-            subprocess.check_output(["git", "ls-files"]).decode().splitlines()
+            check_output(["git", "ls-files"]).decode().splitlines()
         )
 
+        # Warm up the model while the user is still typing
+        threading.Thread(
+            target=self.preload, args=(self.default_model,), daemon=True
+        ).start()
+
         interface = gr.Interface(
             self.submit,
             [
                 gr.Radio(
-                    [
-                        "ollama/qwen3:0.6b",
-                        "ollama/qwen3:1.7b",
-                        "ollama/qwen3:4b",
-                        "ollama/qwen3:8b",
-                        "ollama/qwen3:14b",
-                    ],
-                    value="ollama/qwen3:4b",
+                    self.models,
+                    value=self.default_model,
                     label="model",
                 ),
                 gr.Slider(
@@ -809,6 +1828,11 @@ class PromptVerb(Verb):
                 gr.Checkbox(label="Include selection"),
                 gr.Checkbox(label=f"Include `{self.app.path}`"),
                 gr.Checkbox(label="Don't think (for qwen)", value=True),
+                gr.Checkbox(
+                    label="Stable prefix",
+                    info="Put the question last so ollama can reuse its prompt cache",
+                    value=False,
+                ),
                 gr.Dropdown(
                     project_files,
                     value=[],
@@ -862,7 +1886,10 @@ class PromptVerb(Verb):
 
 
 def main():
-    app = App()
+    if os.environ.get("VERBS_FRONTEND") == "nvim":
+        app = NvimApp()
+    else:
+        app = App()
     app.loadhist()
     try:
         file, line, query = sys.argv[1:]
@@ -877,7 +1904,7 @@ def main():
                 app.go(file, line)
         except FileNotFoundError:
             app.go("~")
-            cwd = app.output("nvr --remote-expr 'getcwd()'", shell=True)
+            cwd = app.vim_eval("getcwd()")
             app.go(cwd)
         app.query = query
     except ValueError: